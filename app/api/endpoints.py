@@ -35,7 +35,6 @@ from app.utils.helpers import (
     _fetch_bundle_all_pages,
     _collect_patient_ids,
     summarize_bundle,
-    _zip_folder,
     snapshot_eds_counts,
     build_merge_report,
 )
@@ -746,19 +745,18 @@ def edsan_to_fhir_zip():
     """
     try:
         tmpdir = Path(tempfile.mkdtemp(prefix="edsan_fhir_"))
-        out_dir = tmpdir / "exports_eds_fhir"
+        zip_path = tmpdir / "edsan_to_fhir.zip"
  
+        # Bundles écrits directement dans le ZIP (pas d'aller-retour par un dossier temporaire)
         export_eds_to_fhir(
             eds_dir=os.getenv("EDS_DIR", "data/eds"),
-            output_dir=out_dir,
+            output_dir=None,
             mapping_path=None,
             fhir_base_url=None,  
             print_summary=False,
+            zip_path=zip_path,
         )
  
-        zip_path = tmpdir / "edsan_to_fhir.zip"
-        _zip_folder(out_dir, zip_path)
- 
         return FileResponse(
             path=str(zip_path),
             filename="edsan_to_fhir.zip",
@@ -1,9 +1,13 @@
 # app/core/converters/eds_merge.py
 from __future__ import annotations
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
 import polars as pl
 
+from app.utils.helpers import PARQUET_WRITE_OPTIONS, parquet_row_count
+
 
 @dataclass
 class MergeReport:
@@ -14,61 +18,100 @@ class MergeReport:
     added_rows: int
 
 
-def _read_parquet_if_exists(path: Path) -> pl.DataFrame | None:
-    if path.exists():
-        return pl.read_parquet(path)
-    return None
-
-
-def _safe_concat(df1: pl.DataFrame, df2: pl.DataFrame) -> pl.DataFrame:
+def _safe_concat(df1: pl.DataFrame | pl.LazyFrame, df2: pl.DataFrame | pl.LazyFrame) -> pl.DataFrame | pl.LazyFrame:
     """
-    Concat vertical robuste:
+    Concat vertical robuste (DataFrame ou LazyFrame, les deux du même type):
     - aligne les colonnes
     - si un même nom de colonne a des types différents entre df1/df2,
       on caste les deux en Utf8 (pour éviter les crashes Polars).
     """
-    if df1 is None or df1.height == 0:
+    if df1 is None or (isinstance(df1, pl.DataFrame) and df1.height == 0):
         return df2
-    if df2 is None or df2.height == 0:
+    if df2 is None or (isinstance(df2, pl.DataFrame) and df2.height == 0):
         return df1
 
     # 1) aligner les colonnes (ajouter les manquantes en null)
+    # 2) harmoniser les types (si mismatch -> cast en Utf8)
+    # => un seul select par frame (pas un with_columns par colonne)
     cols = list(dict.fromkeys(list(df1.columns) + list(df2.columns)))  # union en gardant l'ordre
+    schema1, schema2 = df1.schema, df2.schema
 
-    for c in cols:
-        if c not in df1.columns:
-            df1 = df1.with_columns(pl.lit(None).alias(c))
-        if c not in df2.columns:
-            df2 = df2.with_columns(pl.lit(None).alias(c))
-
-    df1 = df1.select(cols)
-    df2 = df2.select(cols)
+    def _aligned(schema, other_schema) -> list[pl.Expr]:
+        exprs = []
+        for c in cols:
+            e = pl.col(c) if c in schema else pl.lit(None).alias(c)
+            if schema.get(c, pl.Null) != other_schema.get(c, pl.Null):
+                e = e.cast(pl.Utf8, strict=False).alias(c)
+            exprs.append(e)
+        return exprs
 
-    # 2) harmoniser les types (si mismatch -> cast en Utf8)
-    for c in cols:
-        t1 = df1.schema.get(c)
-        t2 = df2.schema.get(c)
-        if t1 != t2:
-            df1 = df1.with_columns(pl.col(c).cast(pl.Utf8, strict=False).alias(c))
-            df2 = df2.with_columns(pl.col(c).cast(pl.Utf8, strict=False).alias(c))
+    df1 = df1.select(_aligned(schema1, schema2))
+    df2 = df2.select(_aligned(schema2, schema1))
 
     # 3) concat
     return pl.concat([df1, df2], how="vertical_relaxed")
 
 
-def _fill_null_keys(df: pl.DataFrame, keys: list[str]) -> pl.DataFrame:
+def _empty_keys_to_null(schema: pl.Schema | dict, keys: list[str]) -> list[pl.Expr]:
+    """
+    Expressions "" -> null pour les colonnes de clé Utf8 présentes dans schema.
+    Les bases écrites par les anciennes versions contiennent "" à la place des
+    clés null (ancien _fill_null_keys), et une clé "" peut aussi arriver dans
+    l'incoming : base et incoming sont ramenés à null des deux côtés pour que
+    "" et null matchent lors de l'anti-join (join_nulls=True).
+    """
+    return [
+        pl.when(pl.col(k) == "").then(None).otherwise(pl.col(k)).alias(k)
+        for k in keys
+        if schema.get(k) == pl.Utf8
+    ]
+
+
+def _base_key_frame(base: pl.DataFrame | pl.LazyFrame, keys: list[str]) -> pl.DataFrame | pl.LazyFrame:
+    """
+    Projection des colonnes de clé de la base, en dtype natif, "" ramené à null
+    (voir _empty_keys_to_null).
+    """
+    return base.select(keys).with_columns(_empty_keys_to_null(base.schema, keys))
+
+
+def _normalize_key_col(
+    k: str, base_dtype: pl.PolarsDataType | None, inc_dtype: pl.PolarsDataType | None
+) -> tuple[pl.Expr | None, pl.Expr | None]:
     """
-    Remplace les null sur les colonnes de clé par une valeur neutre.
-    Utile pour les joins/anti-joins (Polars n'aime pas les clés null en hash join).
+    Expressions de cast (base, incoming) pour une colonne de clé avant l'anti-join.
+    - même dtype : aucun cast (hash join natif, ex: entiers)
+    - un côté en Null (colonne entièrement vide) : cast vers le dtype de l'autre côté
+    - sinon : les deux en Utf8
+    None = pas de cast pour ce côté.
     """
-    exprs = []
-    for k in keys:
-        if k in df.columns:
-            # cast en Utf8 pour éviter des soucis (ex: Date/Int/Null mix)
-            exprs.append(pl.col(k).cast(pl.Utf8, strict=False).fill_null("").alias(k))
-    if exprs:
-        return df.with_columns(exprs)
-    return df
+    if base_dtype == inc_dtype:
+        return None, None
+    if inc_dtype == pl.Null and base_dtype is not None:
+        return None, pl.col(k).cast(base_dtype)
+    if base_dtype == pl.Null and inc_dtype is not None:
+        return pl.col(k).cast(inc_dtype), None
+    return pl.col(k).cast(pl.Utf8, strict=False), pl.col(k).cast(pl.Utf8, strict=False)
+
+
+def _write_lazy_parquet(lf: pl.LazyFrame, path: Path) -> None:
+    """
+    Ecrit un LazyFrame en Parquet en streaming (sink_parquet), de façon atomique :
+    écriture dans path + ".tmp" puis os.replace (le plan peut encore lire path,
+    et un crash en cours d'écriture ne corrompt pas la base).
+    Selon la version de Polars, sink_parquet n'accepte pas tous les plans
+    (ex: anti-join dans une union) : on retombe alors sur collect(streaming=True).
+    """
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    try:
+        try:
+            lf.sink_parquet(tmp_path, **PARQUET_WRITE_OPTIONS)
+        except pl.exceptions.InvalidOperationError:
+            lf.collect(streaming=True).write_parquet(tmp_path, **PARQUET_WRITE_OPTIONS)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
 
 
 def merge_table(
@@ -85,10 +128,8 @@ def merge_table(
 
     # ✅ NEW: si le parquet incoming n’existe pas, on skip proprement
     if not inc_path.exists():
-        before_rows = 0
-        if base_path.exists():
-            base_df = _read_parquet_if_exists(base_path)
-            before_rows = 0 if base_df is None else base_df.height
+        # comptage via le footer parquet (pas de lecture des colonnes)
+        before_rows = parquet_row_count(base_path)
 
         return MergeReport(
             table=table_name,
@@ -98,15 +139,16 @@ def merge_table(
             added_rows=0,
         )
 
-    base = _read_parquet_if_exists(base_path)
-    incoming = pl.read_parquet(inc_path)
+    # Plan lazy : seules les métadonnées (footer) sont lues pour les comptages
+    base_lf = pl.scan_parquet(base_path) if base_path.exists() else None
+    inc_lf = pl.scan_parquet(inc_path)
 
-    before_rows = 0 if base is None else base.height
-    incoming_rows = incoming.height
+    before_rows = 0 if base_lf is None else parquet_row_count(base_path)
+    incoming_rows = parquet_row_count(inc_path)
 
-    # si aucune base, on écrit direct
-    if base is None:
-        incoming.write_parquet(base_path)
+    # si aucune base (ou base vide), on écrit direct
+    if before_rows == 0:
+        _write_lazy_parquet(inc_lf, base_path)
         return MergeReport(
             table=table_name,
             before_rows=0,
@@ -115,31 +157,56 @@ def merge_table(
             added_rows=incoming_rows,
         )
 
-    # aligner colonnes (utile pour avoir des colonnes compatibles)
-    merged_full = _safe_concat(base, incoming)
-
     # MERGE SAFE: on n'enlève jamais des lignes
     if unique_keys:
-        # Remplace nulls sur les colonnes de clé (important pour DOCEDS & co)
-        base_norm = _fill_null_keys(base, unique_keys)
-        inc_norm = _fill_null_keys(incoming, unique_keys)
-
         # On garde toutes les lignes de base
         # Et on ajoute seulement les lignes incoming dont la clé n'existe pas dans base
-        base_keys = base_norm.select(unique_keys).unique()
+        base_keys = _base_key_frame(base_lf, unique_keys)
+        # même normalisation côté incoming : une clé "" ne doit pas être réajoutée
+        # à chaque merge (les lignes ajoutées portent alors null)
+        inc_empty = _empty_keys_to_null(inc_lf.schema, unique_keys)
+        if inc_empty:
+            inc_lf = inc_lf.with_columns(inc_empty)
+
+        # Clés en dtype natif : cast seulement si base/incoming divergent
+        base_schema, inc_schema = base_keys.schema, inc_lf.schema
+        base_casts, inc_casts = [], []
+        for k in unique_keys:
+            base_expr, inc_expr = _normalize_key_col(k, base_schema.get(k), inc_schema.get(k))
+            if base_expr is not None:
+                base_casts.append(base_expr)
+            if inc_expr is not None:
+                inc_casts.append(inc_expr)
+        if base_casts:
+            base_keys = base_keys.with_columns(base_casts)
+        if inc_casts:
+            inc_lf = inc_lf.with_columns(inc_casts)
+
+        # Pré-filtre (semi-join) : on ne garde que les clés de base présentes dans
+        # l'incoming. La table de hachage est construite sur le petit côté (incoming)
+        # et la base est seulement sondée ; l'anti-join ne voit que ces clés.
+        inc_keys = inc_lf.select(unique_keys).unique()
+        base_keys = base_keys.join(inc_keys, on=unique_keys, how="semi", join_nulls=True).unique()
 
         # anti-join: lignes incoming dont les keys ne sont pas dans base
-        inc_new = inc_norm.join(base_keys, on=unique_keys, how="anti")
+        # (join_nulls=True : null == null, plus besoin de remplir les clés)
+        # Seules les nouvelles lignes sont matérialisées (petit volume).
+        inc_new = inc_lf.join(base_keys, on=unique_keys, how="anti", join_nulls=True).collect()
+        added_rows = inc_new.height
 
-        final_df = _safe_concat(base, inc_new)
+        final_lf = _safe_concat(base_lf, inc_new.lazy())
     else:
         # pas de clés => on concatène tout (append)
-        final_df = merged_full
+        added_rows = incoming_rows
+        # aligner colonnes (utile pour avoir des colonnes compatibles)
+        final_lf = _safe_concat(base_lf, inc_lf)
 
-    after_rows = final_df.height
-    added_rows = after_rows - before_rows
+    after_rows = before_rows + added_rows
 
-    final_df.write_parquet(base_path)
+    # rien de nouveau : la base reste telle quelle (pas de réécriture)
+    if added_rows > 0:
+        # écriture atomique (fichier temporaire) : la base est encore lue par le plan
+        _write_lazy_parquet(final_lf, base_path)
 
     return MergeReport(
         table=table_name,
@@ -156,37 +223,41 @@ def merge_run_into_eds(
     table_names: list[str],
     keys_by_table: dict[str, list[str]],
 ) -> list[MergeReport]:
-    reports: list[MergeReport] = []
-
     eds_dir = Path(eds_dir)
     run_dir = Path(run_dir)
 
-    for t in table_names:
-        # on ignore patient.parquet si vous le gardez interne
-        if t == "patient.parquet":
-            continue
-
-        # ✅ NEW: skip si le parquet n’existe pas dans le run
-        if not (run_dir / t).exists():
-            # on renvoie un report "neutre" (pas d'ajout)
-            before_rows = 0
-            base_path = eds_dir / t
-            if base_path.exists():
-                base_df = _read_parquet_if_exists(base_path)
-                before_rows = 0 if base_df is None else base_df.height
-
-            reports.append(
-                MergeReport(
-                    table=t,
-                    before_rows=before_rows,
-                    incoming_rows=0,
-                    after_rows=before_rows,
-                    added_rows=0,
+    # Chaque table a ses propres fichiers source/cible : merges indépendants.
+    # Threads : Polars relâche le GIL pendant la lecture, les joins et l'écriture.
+    # L'ordre des reports suit table_names.
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(table_names)))) as executor:
+        pending: list = []
+        for t in table_names:
+            # on ignore patient.parquet si vous le gardez interne
+            if t == "patient.parquet":
+                continue
+
+            # ✅ NEW: skip si le parquet n’existe pas dans le run
+            if not (run_dir / t).exists():
+                # on renvoie un report "neutre" (pas d'ajout)
+                # comptage via le footer parquet (pas de lecture des colonnes)
+                before_rows = parquet_row_count(eds_dir / t)
+
+                pending.append(
+                    MergeReport(
+                        table=t,
+                        before_rows=before_rows,
+                        incoming_rows=0,
+                        after_rows=before_rows,
+                        added_rows=0,
+                    )
                 )
-            )
-            continue
+                continue
+
+            keys = keys_by_table.get(t, [])
+            pending.append(executor.submit(merge_table, eds_dir, run_dir, t, keys))
 
-        keys = keys_by_table.get(t, [])
-        reports.append(merge_table(eds_dir, run_dir, t, keys))
+        reports: list[MergeReport] = [
+            p.result() if isinstance(p, Future) else p for p in pending
+        ]
 
-    return reports
\ No newline at end of file
+    return reports
@@ -1,16 +1,32 @@
 from __future__ import annotations
  
 import json
+import re
 import base64
 import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
 from pathlib import Path
-from typing import Any
+from itertools import repeat
+from zipfile import ZipFile, ZIP_DEFLATED
+from typing import Any, Callable, Iterable, Sequence
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from app.utils.helpers import clean_id, format_fhir_date
 from datetime import datetime
 import os
 import logging
+
+try:  # sérialisation rapide des bundles si orjson est disponible
+    import orjson
+except ImportError:  # repli sur json (stdlib)
+    orjson = None
  
 FHIR_XHTML_NS = ' xmlns="http://www.w3.org/1999/xhtml"'
  
@@ -20,6 +36,13 @@ DEFAULT_EDS_DIR = PROJECT_ROOT / "data/eds"
 DEFAULT_OUTPUT_DIR = PROJECT_ROOT / "exports_eds_fhir"
 DEFAULT_MAPPING_PATH = Path(__file__).resolve().parent / "mapping.json"
 DEFAULT_REPORTS_DIR = PROJECT_ROOT / "data/reports_export"
+PUSH_MAX_WORKERS = 16  # POST de bundles en parallèle vers le serveur FHIR
+EXPORT_BATCH_SIZE = 65_536  # lignes par lot lues dans un parquet EDS
+# Workers lancés par forkserver (spawn à défaut) : jamais de fork() d'un processus
+# déjà multi-thread (requêtes FastAPI, pools Polars/pyarrow), risque de deadlock.
+_MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
 
 # Configuration des Logs Console
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -33,15 +56,40 @@ def encode_base64(text: str | None) -> str | None:
     return base64.b64encode(str(text).encode("utf-8")).decode("utf-8")
  
 def is_missing(x: Any) -> bool:
-    return x is None or pd.isna(x)
+    # Chemins rapides pour les cas courants (str, float) ; pd.isna pour le reste
+    # (pd.NA, pd.NaT, numpy...).
+    if x is None: return True
+    cls = x.__class__
+    if cls is str: return False
+    if cls is float: return x != x
+    return pd.isna(x)
  
 def stable_id(*parts: object) -> str:
+    # SHA-1 conservé : les ids déjà poussés (PUT) sur les serveurs FHIR en dépendent.
+    # Usage non cryptographique (usedforsecurity=False), même empreinte.
     s = "|".join("" if p is None else str(p) for p in parts)
-    return hashlib.sha1(s.encode("utf-8")).hexdigest()
+    return hashlib.sha1(s.encode("utf-8"), usedforsecurity=False).hexdigest()
+ 
+def stable_ids(resource_type: str, rows: Iterable[Sequence[Any]]) -> list[str]:
+    # Équivalent par lot de stable_id(resource_type, *values) pour chaque ligne de valeurs
+    sha1 = hashlib.sha1
+    prefix = f"{resource_type}|"
+    return [
+        sha1(
+            (prefix + "|".join(["" if v is None else str(v) for v in values])).encode("utf-8"),
+            usedforsecurity=False,
+        ).hexdigest()
+        for values in rows
+    ]
  
 def normalize_fhir_id(raw: Any) -> str:
     if is_missing(raw): return ""
-    s = str(raw)
+    return _normalize_fhir_id_str(str(raw))
+ 
+@lru_cache(maxsize=200_000)
+def _normalize_fhir_id_str(s: str) -> str:
+    # Mémoïsé sur str(raw) (les mêmes PATID/EVTID reviennent sans cesse) ; clé str :
+    # pas de collision 1 / 1.0 / True, et les manquants (NaN) sont filtrés avant.
     if "|" in s: s = s.split("|")[-1]
     if "?" in s or "=" in s:
         s = s.split("|")[-1].split("=")[-1]
@@ -50,7 +98,11 @@ def normalize_fhir_id(raw: Any) -> str:
  
 def normalize_gender(patsex: Any) -> str:
     if is_missing(patsex): return "unknown"
-    s = str(patsex).strip().upper()
+    return _normalize_gender_str(str(patsex))
+ 
+@lru_cache(maxsize=1024)
+def _normalize_gender_str(s: str) -> str:
+    s = s.strip().upper()
     if s == "M": return "male"
     if s == "F": return "female"
     return "unknown"
@@ -65,25 +117,18 @@ def ensure_xhtml_div(text: str) -> str:
 # FHIR Path & Resource Building
 # =============================================================================
  
-def _parse_path(path: str) -> list[Any]:
-    tokens: list[Any] = []
-    buf = ""; i = 0
-    while i < len(path):
-        c = path[i]
-        if c == ".":
-            if buf: tokens.append(buf); buf = ""
-            i += 1; continue
-        if c == "[":
-            if buf: tokens.append(buf); buf = ""
-            j = path.find("]", i)
-            tokens.append(int(path[i + 1:j]))
-            i = j + 1; continue
-        buf += c; i += 1
-    if buf: tokens.append(buf)
-    return tokens
+_PATH_TOKEN_RE = re.compile(r"([^.\[\]]+)|\[(\d+)\]")
  
-def set_path(obj: dict, path: str, value: Any) -> None:
-    tokens = _parse_path(path)
+@lru_cache(maxsize=4096)
+def _parse_path(path: str) -> tuple[Any, ...]:
+    # Mémoïsé : peu de chemins cibles distincts, mais un appel par cellule.
+    # "a.b[0].c" -> ("a", "b", 0, "c")
+    return tuple(
+        int(idx) if idx else name
+        for name, idx in _PATH_TOKEN_RE.findall(path)
+    )
+ 
+def _set_tokens(obj: dict, tokens: tuple[Any, ...], value: Any) -> None:
     cur = obj
     for i, k in enumerate(tokens[:-1]):
         nxt = tokens[i + 1]
@@ -101,36 +146,82 @@ def set_path(obj: dict, path: str, value: Any) -> None:
         cur[last] = value
     else: cur[last] = value
  
-def build_resource(resource_type: str, row: pd.Series, cfg: dict) -> dict:
+def set_path(obj: dict, path: str, value: Any) -> None:
+    _set_tokens(obj, _parse_path(path), value)
+ 
+def compile_mapping(resource_type: str, cfg: dict) -> list[tuple[str, tuple[Any, ...], Callable[[Any], Any]]]:
+    """
+    Pré-compile le mapping d'un type de ressource : (colonne source, chemin parsé, coercion).
+    Le choix de la coercion et le parsing du chemin sont faits une fois, pas par ligne.
+    """
+    return [
+        (src, _parse_path(tgt), _select_coercer(resource_type, tgt, src))
+        for src, tgt in cfg.get("columns", {}).items() if tgt
+    ]
+ 
+_DEFAULT_STATUS = {
+    "Encounter": "finished", "Observation": "final", "MedicationRequest": "active",
+    "DiagnosticReport": "final", "DocumentReference": "current", "Procedure": "completed"
+}
+ 
+def _resource_header(resource_type: str) -> dict:
     res = {"resourceType": resource_type}
-    defaults = {
-        "Encounter": "finished", "Observation": "final", "MedicationRequest": "active",
-        "DiagnosticReport": "final", "DocumentReference": "current", "Procedure": "completed"
-    }
-    if resource_type in defaults: res["status"] = defaults[resource_type]
+    if resource_type in _DEFAULT_STATUS: res["status"] = _DEFAULT_STATUS[resource_type]
     if resource_type == "MedicationRequest": res["intent"] = "order"
+    return res
  
-    for src, tgt in cfg.get("columns", {}).items():
-        if not tgt: continue
-        val = coerce_value(resource_type, tgt, src, row.get(src))
-        if val is not None: set_path(res, tgt, val)
+def build_resource(
+    resource_type: str, row: dict, cfg: dict,
+    fallback_id: str | None = None, program: list | None = None,
+) -> dict:
+    res = _resource_header(resource_type)
+ 
+    if program is None: program = compile_mapping(resource_type, cfg)
+    for src, tokens, coerce in program:
+        raw = row.get(src)
+        val = None if is_missing(raw) else coerce(raw)
+        if val is not None: _set_tokens(res, tokens, val)
  
     if not res.get("id"):
-        res["id"] = stable_id(resource_type, *row.values)
+        res["id"] = fallback_id or stable_id(resource_type, *row.values())
     return res
  
-def coerce_value(resource_type: str, target_path: str, source_col: str, raw: Any) -> Any:
-    if is_missing(raw): return None
-    if resource_type == "Patient" and target_path == "gender": return normalize_gender(raw)
-    if any(h in target_path for h in ["Date", "DateTime", "recorded", "period"]): return format_fhir_date(raw)
-    if target_path == "id": return normalize_fhir_id(raw) or stable_id(raw)
+def _passthrough(raw: Any) -> Any:
+    return raw
+ 
+def _to_id(raw: Any) -> str:
+    return normalize_fhir_id(raw) or stable_id(raw)
+ 
+def _to_reference(prefix: str, raw: Any) -> str:
+    return f"{prefix}/{_to_id(raw)}"
+ 
+@lru_cache(maxsize=None)
+def _select_coercer(resource_type: str, target_path: str, source_col: str) -> Callable[[Any], Any]:
+    # Choix de la coercion : constant par (type de ressource, chemin cible, colonne source)
+    if resource_type == "Patient" and target_path == "gender": return normalize_gender
+    if any(h in target_path for h in ["Date", "DateTime", "recorded", "period"]): return format_fhir_date
+    if target_path == "id": return _to_id
    
     if target_path.endswith(".reference"):
-        nid = normalize_fhir_id(raw) or stable_id(raw)
-        if source_col == "PATID": return f"Patient/{nid}"
-        if source_col == "EVTID": return f"Encounter/{nid}"
-        if source_col == "ELTID" or "Location" in target_path: return f"Location/{nid}"
-    return raw
+        if source_col == "PATID": return partial(_to_reference, "Patient")
+        if source_col == "EVTID": return partial(_to_reference, "Encounter")
+        if source_col == "ELTID" or "Location" in target_path: return partial(_to_reference, "Location")
+    return _passthrough
+ 
+def coerce_value(resource_type: str, target_path: str, source_col: str, raw: Any) -> Any:
+    if is_missing(raw): return None
+    return _select_coercer(resource_type, target_path, source_col)(raw)
+ 
+def _coerce_column(coerce: Callable[[Any], Any], values: pd.Series) -> list[Any]:
+    """
+    Applique une coercion à toute une colonne, une seule fois par valeur distincte
+    (factorize), puis redistribue le résultat par ligne. Les manquants donnent None.
+    Le masque des manquants est celui de factorize (code -1) : pas de pd.isna par cellule.
+    """
+    codes, uniques = pd.factorize(values, use_na_sentinel=True)
+    # None en dernière position : le code -1 (manquant) y pointe lors du take
+    mapped = pd.Series([coerce(u) for u in uniques.tolist()] + [None], dtype=object)
+    return mapped.take(codes).tolist()
  
 # =============================================================================
 # Bundle & Push Logic
@@ -144,7 +235,7 @@ def make_location_stub(location_id: str) -> dict:
         "status": "active"
     }
  
-def build_transaction_bundle(resources: list[dict], bundle_id: str) -> dict:
+def build_transaction_bundle(resources: list[dict], bundle_id: str, bundle_type: str = "transaction") -> dict:
     entries = []
     seen_ids = set()
     referenced_locations = set()
@@ -158,41 +249,265 @@ def build_transaction_bundle(resources: list[dict], bundle_id: str) -> dict:
                 if ref and ref.startswith("Location/"):
                     referenced_locations.add(ref.split("/")[1])
  
-    # 2. Ajouter les ressources principales
+    # 2. Ajouter les ressources principales (clé "Type/id" construite une fois,
+    #    réutilisée pour le dédoublonnage et pour request.url)
     for r in resources:
-        rtype, rid = r.get("resourceType"), r.get("id")
-        if not rid or f"{rtype}/{rid}" in seen_ids: continue
-        seen_ids.add(f"{rtype}/{rid}")
+        rid = r.get("id")
+        if not rid: continue
+        url = f"{r.get('resourceType')}/{rid}"
+        if url in seen_ids: continue
+        seen_ids.add(url)
         entries.append({
             "resource": r,
-            "request": {"method": "PUT", "url": f"{rtype}/{rid}"}
+            "request": {"method": "PUT", "url": url}
         })
  
     # 3. Ajouter les Location manquantes (Stubs) pour éviter les erreurs 400/404
+    stubs = []
     for lid in referenced_locations:
-        if f"Location/{lid}" not in seen_ids:
-            seen_ids.add(f"Location/{lid}")
-            loc_res = make_location_stub(lid)
-            entries.insert(0, { # Insérer au début pour être créé avant l'Encounter
-                "resource": loc_res,
-                "request": {"method": "PUT", "url": f"Location/{lid}"}
+        url = f"Location/{lid}"
+        if url not in seen_ids:
+            seen_ids.add(url)
+            stubs.append({
+                "resource": make_location_stub(lid),
+                "request": {"method": "PUT", "url": url}
             })
+    # Placées en tête (créées avant les Encounter) en une seule fois plutôt qu'un
+    # insert(0) par stub ; ordre inversé comme avec les insertions successives.
+    if stubs:
+        stubs.reverse()
+        entries = stubs + entries
+ 
+    return {"resourceType": "Bundle", "type": bundle_type, "id": bundle_id, "entry": entries}
  
-    return {"resourceType": "Bundle", "type": "transaction", "id": bundle_id, "entry": entries}
+def split_bundle(bundle: dict, chunk_size: int | None) -> list[dict]:
+    # Découpe un bundle trop gros en plusieurs bundles de chunk_size entrées max
+    # (ids suffixés -partN). Les Location stubs, en tête, restent dans le premier :
+    # les parties doivent être envoyées dans l'ordre (voir _push_bundle_parts).
+    entries = bundle["entry"]
+    if not chunk_size or len(entries) <= chunk_size:
+        return [bundle]
+    parts = []
+    for n, start in enumerate(range(0, len(entries), chunk_size), start=1):
+        part = dict(bundle, id=f"{bundle['id']}-part{n}", entry=entries[start:start + chunk_size])
+        parts.append(part)
+    return parts
+ 
+def _make_fhir_session() -> requests.Session:
+    # Session partagée : connexions keep-alive réutilisées entre bundles (pas de
+    # handshake TCP/TLS par POST). Les transactions ne contiennent que des PUT
+    # (idempotents) : on peut rejouer un POST sur 502/503/504.
+    session = requests.Session()
+    retry = Retry(
+        total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504],
+        allowed_methods=None, raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+ 
+_SESSION = _make_fhir_session()
+ 
+def _bundle_body(bundle: dict) -> bytes:
+    # Corps HTTP sérialisé une seule fois en bytes UTF-8 (orjson si disponible)
+    if orjson is not None:
+        return orjson.dumps(bundle)
+    return json.dumps(bundle, ensure_ascii=False, allow_nan=False).encode("utf-8")
  
 def push_bundle_to_fhir(bundle: dict, fhir_base_url: str) -> dict:
-    resp = requests.post(
+    resp = _SESSION.post(
         fhir_base_url.rstrip("/"),
-        json=bundle,
+        data=_bundle_body(bundle),
         headers={"Content-Type": "application/fhir+json"},
         timeout=60
     )
     if not resp.ok: raise RuntimeError(f"FHIR {resp.status_code}: {resp.text[:500]}")
     return resp.json()
  
+def _push_bundle_parts(parts: list[dict], fhir_base_url: str) -> tuple[list[dict], Exception | None]:
+    # Parties -partN d'un même patient poussées dans l'ordre : seule la première porte
+    # le Patient et les Location stubs référencés par les suivantes. Arrêt à la première
+    # erreur ; retourne (réponses des parties envoyées, erreur ou None).
+    results = []
+    for part in parts:
+        try:
+            results.append(push_bundle_to_fhir(part, fhir_base_url))
+        except Exception as e:
+            return results, e
+    return results, None
+ 
+def _bundle_json_bytes(bundle: dict, pretty: bool = False) -> bytes:
+    # Contenu d'un fichier bundle (orjson si disponible).
+    # JSON compact par défaut ; indentation (2) seulement si pretty.
+    if orjson is not None:
+        return orjson.dumps(bundle, option=orjson.OPT_INDENT_2 if pretty else 0)
+    if pretty:
+        return json.dumps(bundle, indent=2, ensure_ascii=False).encode("utf-8")
+    return json.dumps(bundle, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+def write_bundle_json(bundle: dict, path: Path, pretty: bool = False) -> None:
+    # Sérialisation en mémoire puis une seule écriture.
+    path.write_bytes(_bundle_json_bytes(bundle, pretty))
+ 
+def _ref_id(ref: Any) -> str | None:
+    # "Type/id" -> "id" (str.partition : pas de liste intermédiaire)
+    if ref.__class__ is not str: return None
+    _, sep, rid = ref.partition("/")
+    return rid if sep else None
+ 
 def get_patient_id(res: dict) -> str | None:
-    ref = res.get("subject", {}).get("reference") or res.get("patient", {}).get("reference")
-    return ref.split("/", 1)[1] if isinstance(ref, str) and "/" in ref else None
+    ref = None
+    try: ref = res["subject"]["reference"]
+    except (KeyError, TypeError): pass
+    if not ref:
+        try: ref = res["patient"]["reference"]
+        except (KeyError, TypeError): pass
+    return _ref_id(ref)
+
+def _patient_ref_sources(cfg: dict) -> tuple[str | None, str | None]:
+    # Colonnes source de subject.reference / patient.reference (la dernière l'emporte, comme set_path)
+    subject_src = patient_src = None
+    for src, tgt in cfg.get("columns", {}).items():
+        if tgt == "subject.reference": subject_src = src
+        elif tgt == "patient.reference": patient_src = src
+    return subject_src, patient_src
+
+def _build_for_type(rtype: str, cfg: dict, parquet: Path) -> tuple[list[dict], list[str | None]]:
+    """
+    Construit les ressources FHIR d'une table EDS (un type de ressource).
+    Le parquet est lu par lots (iter_batches) : un seul lot décodé en mémoire à la fois.
+    Retourne (ressources, patient_id de chaque ressource) ; exécutée dans un worker.
+    """
+    logging.info(f"Traitement de {rtype}...")
+    # pre_buffer : lectures des column chunks regroupées (utile sur montage réseau/S3)
+    pf = pq.ParquetFile(parquet, pre_buffer=True, buffer_size=1 << 20)
+
+    # Mapping pré-compilé (colonnes présentes dans le parquet uniquement)
+    names = set(pf.schema_arrow.names)
+    program = [entry for entry in compile_mapping(rtype, cfg) if entry[0] in names]
+    subject_src, patient_src = _patient_ref_sources(cfg)
+
+    # Projection (columns=) : seules les colonnes mappées sont décodées, sauf si une
+    # ligne n'a pas d'id mappé (son id de repli dépend de la ligne entière).
+    columns = _projected_columns(pf, cfg, program)
+    widen = _file_dtypes(pf, columns)
+
+    built, pids = [], []
+    for batch in pf.iter_batches(batch_size=EXPORT_BATCH_SIZE, columns=columns):
+        df = batch.to_pandas()
+        if widen: df = df.astype(widen)
+        b_built, b_pids = _build_batch(rtype, cfg, df, program, subject_src, patient_src)
+        built.extend(b_built)
+        pids.extend(b_pids)
+    return built, pids
+
+def _stats_null_count(pf: pq.ParquetFile, name: str) -> int | None:
+    """
+    Nombre de null d'une colonne lu dans les statistiques des row groups (footer, sans
+    décoder la colonne). None si une statistique manque (fichiers écrits sans
+    statistics=True) ou n'est pas fiable : Polars 0.20 écrit null_count=0 pour les
+    colonnes texte (BYTE_ARRAY) même quand elles contiennent des null.
+    """
+    md = pf.metadata
+    j = next((j for j in range(md.num_columns) if md.schema.column(j).path == name), None)
+    if j is None: return None
+    if md.schema.column(j).physical_type == "BYTE_ARRAY" and (md.created_by or "").startswith("Polars"):
+        return None
+    total = 0
+    for i in range(md.num_row_groups):
+        chunk = md.row_group(i).column(j)
+        if not chunk.is_stats_set or not chunk.statistics.has_null_count: return None
+        total += chunk.statistics.null_count
+    return total
+
+def _projected_columns(pf: pq.ParquetFile, cfg: dict, program: list) -> list[str] | None:
+    """
+    Colonnes à lire pour construire les ressources : les colonnes mappées si la colonne
+    id est présente et jamais vide (statistiques du footer, sinon lecture de cette seule
+    colonne pour le vérifier), sinon None (toutes les colonnes, nécessaires au calcul
+    de stable_id).
+    """
+    id_src = None
+    for src, _, _ in program:
+        if cfg["columns"][src] == "id": id_src = src
+    if id_src is None: return None
+    # null_count ne compte pas les NaN : pas de raccourci pour une colonne id flottante
+    nulls = None
+    if not pa.types.is_floating(pf.schema_arrow.field(id_src).type):
+        nulls = _stats_null_count(pf, id_src)
+    if nulls is None:
+        ids = pf.read(columns=[id_src]).column(0)
+        nulls = pc.sum(pc.is_null(ids, nan_is_null=True)).as_py()
+    if nulls: return None
+    return [src for src, _, _ in program]
+
+def _file_dtypes(pf: pq.ParquetFile, columns: list[str] | None) -> dict[str, str]:
+    """
+    Dtypes pandas à imposer à chaque lot pour retrouver ceux d'une lecture complète du
+    fichier. to_pandas() choisit le dtype lot par lot : un entier (ou booléen) qui a des
+    null ailleurs dans le fichier sortirait en int64 (ou bool) dans un lot sans null,
+    et les valeurs hachées par stable_id changeraient ("3" au lieu de "3.0").
+    """
+    schema = pf.schema_arrow
+    widen = {}
+    for name in (columns if columns is not None else schema.names):
+        typ = schema.field(name).type
+        if pa.types.is_integer(typ): target = "float64"
+        elif pa.types.is_boolean(typ): target = "object"
+        else: continue
+        nulls = _stats_null_count(pf, name)
+        if nulls is None:  # pas de statistiques : lecture de la seule colonne
+            nulls = pf.read(columns=[name]).column(0).null_count
+        if nulls: widen[name] = target
+    return widen
+
+def _build_batch(
+    rtype: str, cfg: dict, df: pd.DataFrame, program: list,
+    subject_src: str | None, patient_src: str | None,
+) -> tuple[list[dict], list[str | None]]:
+    """
+    Construit les ressources d'un lot, colonne par colonne : chaque colonne mappée est
+    coercée en une passe, puis les ressources sont assemblées en parcourant les colonnes
+    déjà coercées (pas de dict/Series par ligne source).
+    """
+    srcs = [src for src, _, _ in program]
+    paths = [tokens for _, tokens, _ in program]
+    cols = [_coerce_column(coerce, df[src]) for src, _, coerce in program]
+
+    # ids de repli (lignes sans id mappé) calculés en un seul lot. Ils dépendent de la
+    # ligne entière : seules ces lignes sont relues, toutes colonnes comprises.
+    id_col = None
+    for src, col in zip(srcs, cols):
+        if cfg["columns"][src] == "id": id_col = col
+    missing = [i for i in range(len(df)) if id_col is None or not id_col[i]]
+    fallback = {}
+    if missing:
+        values = df.iloc[missing].itertuples(index=False, name=None)
+        fallback = dict(zip(missing, stable_ids(rtype, values)))
+
+    # Clé de regroupement par patient calculée à la construction (même clé que get_patient_id,
+    # lue dans les références déjà coercées plutôt que dans la ressource)
+    ref_idx = [srcs.index(c) for c in (subject_src, patient_src) if c in srcs]
+
+    header = _resource_header(rtype)
+    built, pids = [], []
+    for i, vals in enumerate(zip(*cols) if cols else repeat((), len(df))):
+        r = dict(header)
+        for tokens, v in zip(paths, vals):
+            if v is not None: _set_tokens(r, tokens, v)
+        if not r.get("id"): r["id"] = fallback[i]
+        if rtype == "Patient":
+            pid = r["id"]
+        else:
+            ref = None
+            for j in ref_idx:
+                ref = vals[j]
+                if ref: break
+            pid = _ref_id(ref)
+        built.append(r)
+        pids.append(pid)
+    return built, pids
 
 # =============================================================================
 # Logs generation
@@ -224,6 +539,14 @@ def save_export_report(summary: dict, errors: list[str]):
     logging.info(f"Rapport d'export archivé : {history_path}")
 
  
+@lru_cache(maxsize=8)
+def _load_mapping_cached(path_str: str, mtime: float) -> dict:
+    # Clé (chemin, mtime) : un mapping modifié sur disque est relu. Ne pas muter le résultat.
+    if orjson is not None:
+        return orjson.loads(Path(path_str).read_bytes())
+    with open(path_str, "r", encoding="utf-8") as f:
+        return json.load(f)
+ 
 # =============================================================================
 # Main Export Function
 # ==============================================================================
@@ -235,56 +558,107 @@ def export_eds_to_fhir(
     bundle_strategy: str = "patient",
     print_summary: bool = True,
     fhir_base_url: str | None = None,
+    bundle_type: str = "transaction",
+    chunk_size: int | None = None,
+    pretty: bool = False,
+    zip_path: str | Path | None = None,
 ) -> dict:
+    """
+    bundle_type : "transaction" (atomique, défaut) ou "batch" (entrées traitées
+    indépendamment par le serveur, sans rollback : plus rapide en ingestion).
+    chunk_size : si renseigné (entier >= 1), les bundles de plus de chunk_size entrées sont découpés
+    (évite les timeouts sur les gros patients) ; réservé à bundle_type="batch" (découper
+    une transaction casserait son atomicité). Les parties d'un même patient sont
+    poussées dans l'ordre, les patients en parallèle.
+    pretty : fichiers JSON indentés (lecture humaine) ; compacts par défaut.
+    zip_path : si renseigné, les bundles sont écrits directement dans cette archive ZIP
+    (sans passer par des fichiers intermédiaires).
+    """
+    if bundle_type not in ("transaction", "batch"):
+        raise ValueError(f"bundle_type invalide: {bundle_type!r} (attendu 'transaction' ou 'batch')")
+    if chunk_size is not None and chunk_size < 1:
+        raise ValueError(f"chunk_size invalide: {chunk_size!r} (attendu un entier >= 1)")
+    if chunk_size and bundle_type == "transaction":
+        raise ValueError("chunk_size n'est pas compatible avec bundle_type='transaction' (utiliser 'batch')")
     eds_dir = Path(eds_dir or DEFAULT_EDS_DIR)
     mapping_path = Path(mapping_path or DEFAULT_MAPPING_PATH)
     out_dir = Path(output_dir) if output_dir else None
 
-    with open(mapping_path, "r", encoding="utf-8") as f:
-        mapping = json.load(f)
+    mapping = _load_mapping_cached(str(mapping_path), mapping_path.stat().st_mtime)
 
-    all_resources = []
+    grouped = {}
     by_type = {}
 
+    tasks = []
     for rtype, cfg in mapping.items():
         if rtype.startswith("_"): continue
         parquet = eds_dir / cfg.get("table_name", "")
         if not parquet.exists(): continue
-        
-        logging.info(f"Traitement de {rtype}...")
-        df = pd.read_parquet(parquet)
-        built = [build_resource(rtype, row, cfg) for _, row in df.iterrows()]
+        tasks.append((rtype, cfg, parquet))
+
+    # Tables indépendantes : construction en parallèle (processus, le code chaud est du Python pur).
+    # Les résultats sont fusionnés dans l'ordre du mapping pour garder des bundles identiques.
+    # Un seul worker possible (1 table ou 1 CPU) : pas de pool, pas de démarrage de processus.
+    max_workers = min(len(tasks), os.cpu_count() or 1)
+    if max_workers > 1:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=_MP_CONTEXT) as pool:
+            results = list(pool.map(_build_for_type, *zip(*tasks)))
+    else:
+        results = [_build_for_type(*t) for t in tasks]
+
+    for (rtype, _, _), (built, pids) in zip(tasks, results):
+        for r, pid in zip(built, pids):
+            if pid: grouped.setdefault(pid, []).append(r)
         by_type[rtype] = len(built)
-        all_resources.extend(built)
 
     bundles = {}
-    grouped = {}
-    for r in all_resources:
-        pid = r["id"] if r["resourceType"] == "Patient" else get_patient_id(r)
-        if pid: grouped.setdefault(pid, []).append(r)
 
     push_errors = []
     success_count = 0
 
+    parts_by_patient = {}
     for pid, resources in grouped.items():
         bid = f"patient-{pid}"
-        bundles[bid] = build_transaction_bundle(resources, bid)
+        parts = split_bundle(build_transaction_bundle(resources, bid, bundle_type), chunk_size)
+        parts_by_patient[bid] = parts
+        for part in parts:
+            bundles[part["id"]] = part
 
     push_results = {}
-    for bid, bundle in bundles.items():
-        if out_dir:
-            out_dir.mkdir(parents=True, exist_ok=True)
-            with open(out_dir / f"{bid}.json", "w", encoding="utf-8") as f:
-                json.dump(bundle, f, indent=2, ensure_ascii=False)
-        
-        if fhir_base_url:
-            # Ajout du try/except pour remplir push_errors
-            try:
-                push_results[bid] = push_bundle_to_fhir(bundle, fhir_base_url)
-                success_count += 1
-            except Exception as e:
-                push_errors.append(f"Erreur Bundle {bid}: {str(e)}")
-                logging.error(f"Échec envoi {bid}: {e}")
+    if out_dir:
+        out_dir.mkdir(parents=True, exist_ok=True)
+        for bid, bundle in bundles.items():
+            write_bundle_json(bundle, out_dir / f"{bid}.json", pretty)
+    if zip_path:
+        # Compression rapide (niveau 1) : le JSON FHIR reste très compressible.
+        zip_path = Path(zip_path)
+        zip_path.parent.mkdir(parents=True, exist_ok=True)
+        with ZipFile(zip_path, "w", compression=ZIP_DEFLATED, compresslevel=1) as zf:
+            for bid, bundle in bundles.items():
+                zf.writestr(f"{bid}.json", _bundle_json_bytes(bundle, pretty))
+
+    if fhir_base_url and bundles:
+        # POST en parallèle par patient (I/O réseau, GIL relâché) via les connexions poolées
+        # de _SESSION ; les parties d'un patient restent séquentielles dans sa tâche.
+        # Résultats relus dans l'ordre des bundles : rapport et erreurs déterministes.
+        with ThreadPoolExecutor(max_workers=min(PUSH_MAX_WORKERS, len(parts_by_patient))) as executor:
+            futures = {
+                bid: executor.submit(_push_bundle_parts, parts, fhir_base_url)
+                for bid, parts in parts_by_patient.items()
+            }
+            for bid, future in futures.items():
+                parts = parts_by_patient[bid]
+                results, error = future.result()
+                for part, result in zip(parts, results):
+                    push_results[part["id"]] = result
+                    success_count += 1
+                if error is not None:
+                    # Ajout pour remplir push_errors (partie en échec puis parties non envoyées)
+                    failed = parts[len(results)]["id"]
+                    push_errors.append(f"Erreur Bundle {failed}: {str(error)}")
+                    logging.error(f"Échec envoi {failed}: {error}")
+                    for part in parts[len(results) + 1:]:
+                        push_errors.append(f"Bundle {part['id']} non envoyé : partie précédente en échec")
 
     summary = {
         "bundles_generated": len(bundles), 
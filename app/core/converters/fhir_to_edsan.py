@@ -1,6 +1,9 @@
 import json
+import multiprocessing
 import os
 import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 
 from app.core.config.merge_keys import MERGE_KEYS
@@ -10,15 +13,21 @@ import glob
 import polars as pl
 
 from app.utils.helpers import (
-    compute_age,
+    PARQUET_WRITE_OPTIONS,
+    compute_age_expr,
     enforce_schema,
     get_value_from_path,
     load_json_flexible,
     _compute_expected_columns,
     _coalesce_from_path,
-    _coalesce_from,
+    _coalesce_pairs,
 )
 
+try:  # parsing rapide des bundles FHIR si orjson est disponible
+    import orjson
+except ImportError:
+    orjson = None
+
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(CURRENT_DIR)))
 
@@ -30,6 +39,17 @@ EDS_DIR = os.path.join(PROJECT_ROOT, "eds")
 REPORTS_DIR = os.path.join(PROJECT_ROOT, "data", "reports")
 REPORTS_DIR_EXPORT = os.path.join(PROJECT_ROOT, "data", "reports_export")
 
+# Workers de parsing lancés par forkserver (spawn à défaut) : build_eds tourne aussi dans
+# les threads de requêtes FastAPI, un fork() d'un processus multi-thread peut bloquer.
+_MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+# Nettoyage des identifiants (PATID/EVTID/ELTID) : préfixes urn:, "Type/" ou "système|".
+# Moteur regex de Polars (Rust) en temps linéaire : pas de retour arrière sur ".*\|".
+_ID_COLS = ["PATID", "EVTID", "ELTID"]
+_ID_CLEANING_REGEX = r"^(urn:uuid:|urn:oid:|[\w]+/|.*\|)"
+
 
 # =============================================================================
 # OUTILS TYPES / NORMALISATION
@@ -62,17 +82,86 @@ def _normalize_value(val, expected_dtype_str: str | None):
     Normalise une valeur brute extraite d'un JSON FHIR selon le type attendu.
     Objectif: éviter les colonnes mixtes (int/str) qui font planter pl.DataFrame(rows).
     """
+    return _value_normalizer(expected_dtype_str)(val)
+
+
+def _normalize_raw(val):
     # Si le JSON renvoie des structures (dict/list), on stringify
     if isinstance(val, (dict, list)):
         return json.dumps(val, ensure_ascii=False)
+    return val
 
-    # Si attendu en texte -> tout en str
+
+def _normalize_text(val):
+    # Attendu en texte -> tout en str (structures en JSON)
+    if val is None:
+        return None
+    if isinstance(val, (dict, list)):
+        return json.dumps(val, ensure_ascii=False)
+    return str(val)
+
+
+def _value_normalizer(expected_dtype_str: str | None):
+    """
+    Choisit une fois par colonne la normalisation de _normalize_value
+    (appelée ensuite directement pour chaque cellule, sans re-tester le dtype).
+    """
     if expected_dtype_str in ("Utf8", "String", "str"):
-        if val is None:
-            return None
-        return str(val)
+        return _normalize_text
+    return _normalize_raw
 
-    return val
+
+def _load_bundle_file(file_path: str) -> dict:
+    """
+    Lit un bundle FHIR en une seule lecture binaire puis le décode
+    (orjson si disponible, sinon json).
+    """
+    data = Path(file_path).read_bytes()
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # NaN/Infinity, entiers > 64 bits... : json les accepte, on garde son comportement
+            pass
+    return json.loads(data)
+
+
+def _extract_file(file_path: str, compiled_rules: dict) -> tuple[dict | None, str | None]:
+    """
+    Extrait les lignes EDS d'un fichier bundle : ({table: [tuple, ...]}, None),
+    (None, message) si le fichier est illisible, (None, None) s'il n'a pas d'entry.
+    Fonction de module : exécutable dans un processus de travail.
+    """
+    try:
+        bundle = _load_bundle_file(file_path)
+    except Exception as e:
+        return None, f"[ATTENTION] Erreur lecture {file_path}: {e}"
+
+    if "entry" not in bundle:
+        return None, None
+
+    rows: dict[str, list[tuple]] = {}
+    get_rule = compiled_rules.get
+    for entry in bundle["entry"]:
+        resource = entry.get("resource", {})
+
+        # Application des regles de mapping si le type de ressource est configure
+        # (une seule recherche : les types non mappes sont ecartes par le None)
+        rule = get_rule(resource.get("resourceType"))
+        if rule is None:
+            continue
+        target_table, width, slots = rule
+
+        new_row = [None] * width
+        for pos, json_path, normalize in slots:
+            raw_val = get_value_from_path(resource, json_path)
+
+            # normalisation selon _schemas pour éviter colonnes mixtes
+            new_row[pos] = normalize(raw_val)
+
+        rows.setdefault(target_table, []).append(tuple(new_row))
+
+    return rows, None
 
 
 # =============================================================================
@@ -121,10 +210,44 @@ def build_eds(
     mapping_rules = {k: v for k, v in mapping_raw.items() if not str(k).startswith("_")}
     expected_columns = _compute_expected_columns(mapping_rules, schemas)
 
-    # Preparation des buffers d'extraction
+    # Preparation des buffers d'extraction : une ligne = un tuple aligne sur les colonnes
+    # de la table (plus compact qu'un dict par ligne, pas de hachage de cles)
     table_names = {rule["table_name"] for rule in mapping_rules.values()}
     buffers = {t: [] for t in table_names}
 
+    table_columns: dict[str, list[str]] = {}
+    for t in table_names:
+        table_columns[t] = list(expected_columns.get(t, []))
+        if not table_columns[t]:
+            # Pas de colonnes attendues : toutes les colonnes mappees, dans l'ordre du mapping
+            for rule in mapping_rules.values():
+                if rule["table_name"] == t:
+                    for c in rule.get("columns", {}):
+                        if c not in table_columns[t]:
+                            table_columns[t].append(c)
+
+    # Regles compilees une fois par type de ressource :
+    # (table, nb colonnes, [(position, chemin JSON, normalisation), ...])
+    compiled_rules = {}
+    for rtype, rule in mapping_rules.items():
+        target_table = rule["table_name"]
+        positions = {c: i for i, c in enumerate(table_columns[target_table])}
+
+        # schema attendu pour cette table (si présent)
+        table_schema = {}
+        if isinstance(schemas, dict):
+            table_schema = schemas.get(target_table, {}) or {}
+
+        slots = []
+        for col_name, json_path in rule.get("columns", {}).items():
+            if col_name not in positions:
+                continue  # colonne hors schema : ignoree a la construction du DataFrame
+            expected_dtype_str = None
+            if isinstance(table_schema, dict):
+                expected_dtype_str = table_schema.get(col_name)
+            slots.append((positions[col_name], json_path, _value_normalizer(expected_dtype_str)))
+        compiled_rules[rtype] = (target_table, len(positions), slots)
+
     fhir_files = glob.glob(os.path.join(fhir_dir, "*.json"))
     if verbose:
         print(f"Traitement de {len(fhir_files)} fichiers source...")
@@ -134,47 +257,30 @@ def build_eds(
     # -------------------------------------------------------------------------
     # EXTRACTION (Parsing JSON)
     # -------------------------------------------------------------------------
-    for idx, file_path in enumerate(fhir_files, start=1):
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                bundle = json.load(f)
-        except Exception as e:
-            msg = f"[ATTENTION] Erreur lecture {file_path}: {e}"
+    # Fichiers indépendants : parsing en parallèle (processus, parsing JSON et parcours
+    # des ressources en Python pur). Résultats relus dans l'ordre des fichiers :
+    # lignes, avertissements et compteurs identiques à un traitement séquentiel.
+    extract = partial(_extract_file, compiled_rules=compiled_rules)
+    max_workers = min(len(fhir_files), os.cpu_count() or 1)
+    if max_workers > 1:
+        chunksize = max(1, len(fhir_files) // (max_workers * 4))
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=_MP_CONTEXT) as pool:
+            results = list(pool.map(extract, fhir_files, chunksize=chunksize))
+    else:
+        results = map(extract, fhir_files)
+
+    for idx, (file_rows, msg) in enumerate(results, start=1):
+        if msg:
             if verbose:
                 print(msg)
             summary["warnings"].append(msg)
             continue
 
-        if "entry" not in bundle:
+        if file_rows is None:
             continue
 
-        for entry in bundle["entry"]:
-            resource = entry.get("resource", {})
-            rtype = resource.get("resourceType")
-
-            # Application des regles de mapping si le type de ressource est configure
-            if rtype in mapping_rules:
-                rule = mapping_rules[rtype]
-                target_table = rule["table_name"]
-                columns_map = rule.get("columns", {})
-
-                # schema attendu pour cette table (si présent)
-                table_schema = {}
-                if isinstance(schemas, dict):
-                    table_schema = schemas.get(target_table, {}) or {}
-
-                new_row = {}
-                for col_name, json_path in columns_map.items():
-                    raw_val = get_value_from_path(resource, json_path)
-
-                    # normalisation selon _schemas pour éviter colonnes mixtes
-                    expected_dtype_str = None
-                    if isinstance(table_schema, dict):
-                        expected_dtype_str = table_schema.get(col_name)
-
-                    new_row[col_name] = _normalize_value(raw_val, expected_dtype_str)
-
-                buffers[target_table].append(new_row)
+        for target_table, rows in file_rows.items():
+            buffers[target_table].extend(rows)
 
         summary["files_processed"] += 1
         if verbose and idx % 10 == 0:
@@ -182,8 +288,12 @@ def build_eds(
 
     # -------------------------------------------------------------------------
     # Conversion en DataFrames Polars (robuste aux types mixtes)
+    # Les regles metier qui suivent sont des plans lazy, executes en une fois
+    # (collect_all) juste avant l'ecriture.
     # -------------------------------------------------------------------------
-    dfs: dict[str, pl.DataFrame] = {}
+    dfs: dict[str, pl.LazyFrame] = {}
+    # Tables non vides (les transformations qui suivent ne suppriment pas de lignes)
+    nonempty = {t for t in table_names if buffers.get(t)}
 
     for table_name in table_names:
         rows = buffers.get(table_name, [])
@@ -191,31 +301,30 @@ def build_eds(
         cols = expected_columns.get(table_name, [])
 
         if not rows:
-            dfs[table_name] = pl.DataFrame({c: [] for c in cols}) if cols else pl.DataFrame()
+            dfs[table_name] = (pl.DataFrame({c: [] for c in cols}) if cols else pl.DataFrame()).lazy()
             continue
 
         # Forcer les colonnes attendues en string à la construction du DF (robustesse)
-        schema = {c: pl.Utf8 for c in cols} if cols else None
+        # (orient="row" : même conversion des valeurs que pl.from_dicts)
+        schema = {c: pl.Utf8 for c in cols} if cols else table_columns[table_name]
 
-        dfs[table_name] = pl.from_dicts(
+        dfs[table_name] = pl.DataFrame(
             rows,
             schema=schema,
+            orient="row",
             infer_schema_length=None,
-        )
+        ).lazy()
 
     # -------------------------------------------------------------------------
     # ETAPE 1 : NETTOYAGE DES IDENTIFIANTS
     # -------------------------------------------------------------------------
-    id_cols = ["PATID", "EVTID", "ELTID"]
-    id_cleaning_regex = r"^(urn:uuid:|urn:oid:|[\w]+/|.*\|)"
-
     for table_name, df in dfs.items():
-        if df.height > 0:
-            cols_to_clean = [c for c in id_cols if c in df.columns]
+        if table_name in nonempty:
+            cols_to_clean = [c for c in _ID_COLS if c in df.columns]
             if cols_to_clean:
                 dfs[table_name] = df.with_columns(
                     [
-                        pl.col(c).cast(pl.Utf8).str.replace(id_cleaning_regex, "").alias(c)
+                        pl.col(c).cast(pl.Utf8).str.replace(_ID_CLEANING_REGEX, "").alias(c)
                         for c in cols_to_clean
                     ]
                 )
@@ -225,7 +334,7 @@ def build_eds(
     # -------------------------------------------------------------------------
     # ETAPE 2 : REGLES METIERS PATIENT
     # -------------------------------------------------------------------------
-    if "patient.parquet" in dfs and dfs["patient.parquet"].height > 0:
+    if "patient.parquet" in nonempty:
         df_pat = dfs["patient.parquet"]
 
         # Normalisation du sexe (Standardisation M/F/I)
@@ -238,7 +347,7 @@ def build_eds(
         # Calcul de l'age a partir de la date de naissance
         if "PATBD" in df_pat.columns:
             df_pat = df_pat.with_columns(
-                pl.col("PATBD").map_elements(compute_age, return_dtype=pl.Int64).alias("PATAGE")
+                compute_age_expr("PATBD").alias("PATAGE")
             )
 
         dfs["patient.parquet"] = df_pat
@@ -248,7 +357,7 @@ def build_eds(
     # -------------------------------------------------------------------------
     # ETAPE 3 : REGLES METIERS MOUVEMENT (MVT)
     # -------------------------------------------------------------------------
-    if "mvt.parquet" in dfs and dfs["mvt.parquet"].height > 0:
+    if "mvt.parquet" in nonempty:
         df_mvt = dfs["mvt.parquet"]
 
         # Valeur par defaut pour l'unite medicale
@@ -261,25 +370,20 @@ def build_eds(
     # ETAPE 4 : ENRICHISSEMENT (JOINTURES)
     # -------------------------------------------------------------------------
     patient_light = None
-    if (
-        "patient.parquet" in dfs
-        and dfs["patient.parquet"].height > 0
-        and "PATID" in dfs["patient.parquet"].columns
-    ):
+    if "patient.parquet" in nonempty and "PATID" in dfs["patient.parquet"].columns:
         cols_needed = [c for c in ["PATID", "PATBD", "PATAGE", "PATSEX"] if c in dfs["patient.parquet"].columns]
         patient_light = dfs["patient.parquet"].select(cols_needed)
 
-    if "mvt.parquet" in dfs and dfs["mvt.parquet"].height > 0 and patient_light is not None:
+    if "mvt.parquet" in nonempty and patient_light is not None:
         if "PATID" in dfs["mvt.parquet"].columns:
             df_mvt = dfs["mvt.parquet"].join(patient_light, on="PATID", how="left", suffix="_pat")
-            df_mvt = _coalesce_from(df_mvt, "PATAGE", "PATAGE_pat")
-            df_mvt = _coalesce_from(df_mvt, "PATSEX", "PATSEX_pat")
+            df_mvt = _coalesce_pairs(df_mvt, [("PATAGE", "PATAGE_pat"), ("PATSEX", "PATSEX_pat")])
             dfs["mvt.parquet"] = df_mvt
             if verbose:
                 print("   [Enrichissement] Mvt enrichi avec donnees Patient.")
 
     mvt_light = None
-    if "mvt.parquet" in dfs and dfs["mvt.parquet"].height > 0 and "EVTID" in dfs["mvt.parquet"].columns:
+    if "mvt.parquet" in nonempty and "EVTID" in dfs["mvt.parquet"].columns:
         cols_needed = [
             c
             for c in ["EVTID", "PATID", "SEJUM", "SEJUF", "DATENT", "DATSORT", "PATAGE", "PATSEX"]
@@ -288,39 +392,37 @@ def build_eds(
         mvt_light = dfs["mvt.parquet"].select(cols_needed)
 
     def apply_enrichment(target_table_name):
-        if target_table_name not in dfs or dfs[target_table_name].height == 0:
+        if target_table_name not in nonempty:
             return
 
         df = dfs[target_table_name]
 
         if patient_light is not None and "PATID" in df.columns:
             df = df.join(patient_light, on="PATID", how="left", suffix="_pat")
-            df = _coalesce_from(df, "PATAGE", "PATAGE_pat")
-            df = _coalesce_from(df, "PATSEX", "PATSEX_pat")
-            df = _coalesce_from(df, "PATBD", "PATBD_pat")
+            df = _coalesce_pairs(df, [("PATAGE", "PATAGE_pat"), ("PATSEX", "PATSEX_pat"), ("PATBD", "PATBD_pat")])
 
         if mvt_light is not None and "EVTID" in df.columns:
             df = df.join(mvt_light, on="EVTID", how="left", suffix="_mvt")
-            df = _coalesce_from(df, "SEJUM", "SEJUM_mvt")
-            df = _coalesce_from(df, "SEJUF", "SEJUF_mvt")
-            df = _coalesce_from(df, "DATENT", "DATENT_mvt")
-            df = _coalesce_from(df, "DATSORT", "DATSORT_mvt")
-            df = _coalesce_from(df, "PATID", "PATID_mvt")
-            df = _coalesce_from(df, "PATAGE", "PATAGE_mvt")
-            df = _coalesce_from(df, "PATSEX", "PATSEX_mvt")
+            df = _coalesce_pairs(
+                df,
+                [
+                    (c, f"{c}_mvt")
+                    for c in ["SEJUM", "SEJUF", "DATENT", "DATSORT", "PATID", "PATAGE", "PATSEX"]
+                ],
+            )
 
         dfs[target_table_name] = df
 
     tables_to_enrich = ["biol.parquet", "pharma.parquet", "doceds.parquet", "pmsi.parquet"]
     for t in tables_to_enrich:
         apply_enrichment(t)
-        if verbose and t in dfs and dfs[t].height > 0:
+        if verbose and t in nonempty:
             print(f"   [Enrichissement] {t} enrichi.")
 
     # -------------------------------------------------------------------------
     # ETAPE 5 : CALCUL DUREE SEJOUR (PMSI)
     # -------------------------------------------------------------------------
-    if "pmsi.parquet" in dfs and dfs["pmsi.parquet"].height > 0:
+    if "pmsi.parquet" in nonempty:
         df_pmsi = dfs["pmsi.parquet"]
 
         if "DATENT" in df_pmsi.columns and "DATSORT" in df_pmsi.columns:
@@ -355,31 +457,54 @@ def build_eds(
         "pmsi.parquet",
     ]
 
-    for table_name in output_order:
-        df = dfs.get(table_name, pl.DataFrame())
+    # Application stricte du schema attendu, puis execution de tous les plans en une fois :
+    # sous-plans communs (patient_light, mvt_light) calcules une seule fois, tables en parallele
+    plans = {
+        t: enforce_schema(dfs[t], t, expected_columns) for t in output_order if t in nonempty
+    }
+    collected = dict(zip(plans, pl.collect_all(list(plans.values()))))
 
-        if df.height == 0:
+    to_write: dict[str, pl.DataFrame] = {}
+
+    for table_name in output_order:
+        if table_name not in collected:
             summary["tables"][table_name] = {"rows": 0, "cols": 0, "generated": False}
             summary["empty_tables"].append(table_name)
             if verbose:
                 print(f"[INFO] {table_name} vide, fichier non genere.")
             continue
 
-        # Application stricte du schema attendu
-        df = enforce_schema(df, table_name, expected_columns)
+        df = collected[table_name]
+        to_write[table_name] = df
+
+        summary["tables"][table_name] = {"rows": df.height, "cols": len(df.columns), "generated": True}
 
+    def _write_table(table_name: str, df: pl.DataFrame) -> None:
         output_path = os.path.join(eds_dir, table_name)
+        tmp_path = output_path + ".tmp"
 
+        # Ecriture atomique : un crash en cours d'ecriture ne laisse pas de parquet tronque.
+        # Memes options que les tables fusionnees (zstd 3, statistiques, row groups bornes).
         try:
-            df.write_parquet(output_path)
+            df.write_parquet(tmp_path, **PARQUET_WRITE_OPTIONS)
+            os.replace(tmp_path, output_path)
         except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
             raise RuntimeError(
                 f"[WRITE_PARQUET FAIL] table={table_name} path={output_path} schema={df.schema} -> {e}"
             ) from e
 
-        summary["tables"][table_name] = {"rows": df.height, "cols": len(df.columns), "generated": True}
+    # Ecriture des tables en parallele : la compression Parquet (cote Rust)
+    # relache le GIL, le temps total tend vers celui de la plus grosse table.
+    if to_write:
+        with ThreadPoolExecutor(max_workers=len(to_write)) as executor:
+            futures = [executor.submit(_write_table, t, df) for t, df in to_write.items()]
+            for future in futures:
+                future.result()
 
-        if verbose:
+    if verbose:
+        for table_name, df in to_write.items():
             print(f"[SUCCES] {table_name} genere ({df.height} lignes)")
 
     if verbose:
@@ -444,40 +569,51 @@ def process_bundle(
     """
     target_eds_dir = eds_dir or EDS_DIR
 
-    with tempfile.TemporaryDirectory() as tmp_fhir:
-        # 1) Sauvegarde du bundle temporaire
+    # Un seul dossier temporaire (bundle + run dir) : un mkdtemp/rmtree par appel
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_fhir = os.path.join(tmp, "fhir")
+        os.makedirs(tmp_fhir)
+
+        # 1) Sauvegarde du bundle temporaire (sérialisé en mémoire, une seule écriture)
         bundle_path = os.path.join(tmp_fhir, "bundle.json")
-        with open(bundle_path, "w", encoding="utf-8") as f:
-            json.dump(bundle, f)
+        data = None
+        if orjson is not None:
+            try:
+                data = orjson.dumps(bundle)
+            except orjson.JSONEncodeError:
+                # entiers > 64 bits... : json les accepte, on garde son comportement
+                pass
+        if data is None:
+            data = json.dumps(bundle).encode("utf-8")
+        Path(bundle_path).write_bytes(data)
 
         # 2) Run dir parquet temporaire (évite d’écraser eds/)
-        with tempfile.TemporaryDirectory() as tmp_run:
-            run_dir = str(Path(tmp_run))
-
-            # Génération parquet dans run_dir (PAS dans eds/)
-            result = build_eds(
-                fhir_dir=tmp_fhir,
-                eds_dir=run_dir,
-                mapping_file=mapping_file,
-                verbose=True,
-            )
+        run_dir = os.path.join(tmp, "run")
 
-            # 3) Merge run_dir -> target_eds_dir
-            merge_reports = merge_run_into_eds(
-                eds_dir=target_eds_dir,
-                run_dir=run_dir,
-                table_names=list(result["tables"].keys()),
-                keys_by_table=MERGE_KEYS,
-            )
+        # Génération parquet dans run_dir (PAS dans eds/)
+        result = build_eds(
+            fhir_dir=tmp_fhir,
+            eds_dir=run_dir,
+            mapping_file=mapping_file,
+            verbose=True,
+        )
 
-            result["merge"] = [r.__dict__ for r in merge_reports]
-            result["merged_into"] = target_eds_dir
+        # 3) Merge run_dir -> target_eds_dir
+        merge_reports = merge_run_into_eds(
+            eds_dir=target_eds_dir,
+            run_dir=run_dir,
+            table_names=list(result["tables"].keys()),
+            keys_by_table=MERGE_KEYS,
+        )
 
-            # 4) sauvegarde report
-            # if write_report:
-            #     _write_last_run(result, target_eds_dir)
+        result["merge"] = [r.__dict__ for r in merge_reports]
+        result["merged_into"] = target_eds_dir
 
-            return result
+        # 4) sauvegarde report
+        # if write_report:
+        #     _write_last_run(result, target_eds_dir)
+
+        return result
 
 
 if __name__ == "__main__":
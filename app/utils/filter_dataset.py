@@ -2,10 +2,13 @@
 from __future__ import annotations
 
 import argparse
+import os
 import re
 import shutil
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
 from typing import Callable
 
@@ -41,6 +44,7 @@ def _strip_quotes(s: str) -> str:
     return s
 
 
+@lru_cache(maxsize=256)
 def _parse_table_pattern(pat: str) -> Callable[[str], bool]:
     pat = (pat or "").strip()
     if pat in ("", "*"):
@@ -151,10 +155,61 @@ def _to_expr(col: str, op: str, raw: str) -> pl.Expr:
     raise ValueError(op)
 
 
+def _apply_where(
+    lf: pl.LazyFrame,
+    clauses: list[tuple[WhereClause, Callable[[str], bool]]],
+    stem: str,
+) -> pl.LazyFrame:
+    """
+    Applique en un seul filter() toutes les clauses WHERE qui visent la table `stem`
+    (et dont la colonne existe) : un seul arbre booléen pour l'optimiseur, poussé
+    dans le scan parquet. `clauses` associe chaque clause à son matcher de table.
+    """
+    schema = lf.schema
+    preds = [
+        _to_expr(cl.col, cl.op, cl.raw_value)
+        for cl, matches in clauses
+        if matches(stem) and cl.col in schema
+    ]
+    if not preds:
+        return lf
+    return lf.filter(pl.all_horizontal(preds))
+
+
 # =============================================================================
 # Core filtering logic (EXISTANT)
 # =============================================================================
 
+def _sink_parquet(lf: pl.LazyFrame, path: Path) -> None:
+    """
+    Écrit le plan filtré en streaming (scan -> filtres -> fichier, par lots),
+    sans matérialiser la table filtrée. Repli sur collect(streaming=True) si le
+    plan n'est pas supporté par le moteur streaming de cette version de Polars.
+    """
+    try:
+        lf.sink_parquet(path)
+    except pl.exceptions.InvalidOperationError:
+        lf.collect(streaming=True).write_parquet(path)
+
+
+def _write_filtered(
+    f: Path,
+    clauses: list[tuple[WhereClause, Callable[[str], bool]]],
+    propagated_keys: dict[str, pl.DataFrame],
+    out_dir: Path,
+) -> None:
+    """PASS 2 pour un fichier : scan -> WHERE -> semi-jointures de propagation -> parquet."""
+    lf = _apply_where(pl.scan_parquet(str(f)), clauses, f.stem)
+
+    schema = lf.schema
+    for key, keys_df in propagated_keys.items():
+        if key in schema:
+            keys_lf = keys_df.lazy().select(pl.col(key).cast(schema[key]))
+            lf = lf.join(keys_lf, on=key, how="semi")
+
+    _sink_parquet(lf, out_dir / f.name)
+
+
 def filter_folder(
     input_dir: str,
     output_dir: str,
@@ -170,11 +225,15 @@ def filter_folder(
     out_dir.mkdir(parents=True, exist_ok=True)
 
     files = sorted(in_dir.glob("*.parquet"))
-    clauses = [parse_where(w) for w in (where or [])]
+    # matchers de table calculés une seule fois, hors des boucles sur les fichiers
+    clauses = [
+        (cl, _parse_table_pattern(cl.table_pat))
+        for cl in (parse_where(w) for w in (where or []))
+    ]
     prop_specs = [parse_propagate(p) for p in (propagate or [])]
 
-    # PASS 1 — propagation keys
-    propagated_sets: dict[str, set] = {}
+    # PASS 1 — propagation keys (une table de clés distinctes par colonne)
+    propagated_keys: dict[str, pl.DataFrame] = {}
 
     for spec in prop_specs:
         matcher = _parse_table_pattern(spec.source_table_pat)
@@ -188,9 +247,7 @@ def filter_folder(
             if spec.key_col not in lf.schema:
                 continue
 
-            for cl in clauses:
-                if _parse_table_pattern(cl.table_pat)(f.stem) and cl.col in lf.schema:
-                    lf = lf.filter(_to_expr(cl.col, cl.op, cl.raw_value))
+            lf = _apply_where(lf, clauses, f.stem)
 
             if propagate_drop_nulls:
                 lf = lf.filter(pl.col(spec.key_col).is_not_null())
@@ -198,23 +255,25 @@ def filter_folder(
             unions.append(lf.select(spec.key_col))
 
         if unions:
-            propagated_sets[spec.key_col] = set(
-                pl.concat(unions).unique().collect()[spec.key_col].to_list()
+            # is_in() ne fait jamais correspondre null : on retire donc les null
+            # des clés pour que la semi-jointure garde la même sémantique.
+            propagated_keys[spec.key_col] = (
+                pl.concat(unions).unique().drop_nulls().collect()
             )
 
     # PASS 2 — write filtered tables
-    for f in files:
-        lf = pl.scan_parquet(str(f))
-
-        for cl in clauses:
-            if _parse_table_pattern(cl.table_pat)(f.stem) and cl.col in lf.schema:
-                lf = lf.filter(_to_expr(cl.col, cl.op, cl.raw_value))
-
-        for key, vals in propagated_sets.items():
-            if key in lf.schema:
-                lf = lf.filter(pl.col(key).is_in(list(vals)))
-
-        lf.collect(streaming=True).write_parquet(out_dir / f.name)
+    # Fichiers indépendants : threads, Polars relâche le GIL pendant scan/filtre/écriture
+    # (pool de threads Polars partagé, pas de sur-souscription). Résultats relus dans
+    # l'ordre des fichiers pour remonter la première erreur de façon déterministe.
+    if files:
+        max_workers = min(len(files), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(_write_filtered, f, clauses, propagated_keys, out_dir)
+                for f in files
+            ]
+            for future in futures:
+                future.result()
 
 
 # =============================================================================
@@ -19,6 +19,7 @@ import requests
 from dotenv import load_dotenv
 import os
 from collections import Counter
+from functools import lru_cache
 
 import polars as pl
 
@@ -35,6 +36,11 @@ FHIR_ACCEPT_HEADERS = {"Accept": "application/fhir+json"}
 # FHIR / generic text helpers
 # -----------------------------------------------------------------------------
  
+# Compilée une seule fois : clean_id est appelée pour chaque référence lue/écrite.
+_ID_PREFIX_RE = re.compile(
+    r"^(urn:uuid:|Patient/|Encounter/|Observation/|Procedure/|Condition/|MedicationRequest/|Location/)"
+)
+
 def clean_id(raw_id: Optional[str]) -> str:
     """Nettoie les identifiants FHIR pour ne garder que la partie unique.
    
@@ -51,11 +57,7 @@ def clean_id(raw_id: Optional[str]) -> str:
     # Supprime les préfixes courants via une expression régulière (Regex).
     # Le '^' signifie "qui commence par".
     # Le '|' signifie "OU" (Patient/ OU Encounter/ OU ...).
-    return re.sub(
-        r"^(urn:uuid:|Patient/|Encounter/|Observation/|Procedure/|Condition/|MedicationRequest/|Location/)",
-        "",
-        raw_id,
-    )
+    return _ID_PREFIX_RE.sub("", raw_id, count=1)
  
 
 def _normalize_value(value, expected_dtype: str | None):
@@ -191,11 +193,50 @@ def compute_age(
         # En cas de format de date invalide, on ne fait pas planter le script, on renvoie None
         return None
  
+
+def compute_age_expr(col: str, reference_date: Optional[date] = None) -> pl.Expr:
+    """Équivalent vectorisé (expression Polars) de compute_age sur une colonne texte ISO.
+
+    Même règle que compute_age : partie avant "T", lue comme datetime.fromisoformat
+    (YYYY-MM-DD ou YYYYMMDD, éventuellement suivie d'une heure), anniversaire pas encore
+    passé -> -1. Les dates illisibles (non zéro-paddées, YYYY-MM, ...) donnent null,
+    comme None côté compute_age. Seules les dates en semaine ISO (1990-W01-1) ne sont
+    pas reconnues.
+    """
+    if reference_date is None:
+        reference_date = date.today()
+
+    date_part = pl.col(col).str.split("T").list.first()
+    birth = pl.coalesce(
+        date_part.str.extract(r"^(\d{4}-\d{2}-\d{2})(?:\D\d{2}.*)?$", 1).str.to_date("%Y-%m-%d", strict=False),
+        date_part.str.extract(r"^(\d{8})(?:\D\d{2}.*)?$", 1).str.to_date("%Y%m%d", strict=False),
+    )
+    not_yet = (birth.dt.month() > reference_date.month) | (
+        (birth.dt.month() == reference_date.month) & (birth.dt.day() > reference_date.day)
+    )
+    return (reference_date.year - birth.dt.year().cast(pl.Int64) - not_yet.cast(pl.Int64)).cast(pl.Int64)
+
  
 # -----------------------------------------------------------------------------
 # JSON helpers used by mapping/build scripts
 # -----------------------------------------------------------------------------
  
+_FHIR_REF_PREFIXES = ("urn:uuid:", "Patient/", "Encounter/", "Practitioner/", "Location/")
+
+
+@lru_cache(maxsize=None)
+def _json_path_tokens(path: str) -> tuple:
+    """Découpe un chemin 'a.b[0].c' en ('a', 'b', 0, 'c').
+
+    Les chemins viennent de mapping.json (quelques dizaines au plus) : le résultat
+    est mis en cache pour ne pas re-découper la même chaîne à chaque ressource.
+    """
+    return tuple(
+        int(k) if k.isdigit() else k
+        for k in path.replace("[", ".").replace("]", "").split(".")
+    )
+
+
 def get_value_from_path(data: dict, path: str):
     """Navigue dans un JSON via un chemin type 'a.b[0].c'.
  
@@ -211,30 +252,32 @@ def get_value_from_path(data: dict, path: str):
     if path == "resourceType":
         return data.get("resourceType")
  
-    # Transformation du chemin : "a.b[0].c" devient une liste ["a", "b", "0", "c"]
-    elements = path.replace("[", ".").replace("]", "").split(".")
+    # Transformation du chemin : "a.b[0].c" devient ("a", "b", 0, "c") (mis en cache)
     current = data
  
-    for key in elements:
+    for key in _json_path_tokens(path):
         if current is None:
             return None
- 
+
+        # Le JSON décodé ne contient que des dict/list "exacts" : un test de classe
+        # suffit et coûte moins cher qu'isinstance() dans cette boucle très chaude.
         # Si la clé est un nombre, on essaie d'accéder à un index de liste
-        if key.isdigit():
-            idx = int(key)
-            if isinstance(current, list) and len(current) > idx:
-                current = current[idx]
+        if key.__class__ is int:
+            if current.__class__ is list and len(current) > key:
+                current = current[key]
             else:
                 return None # Index hors limites
-        # Sinon, on essaie d'accéder à une clé de dictionnaire
-        elif isinstance(current, dict) and key in current:
-            current = current[key]
+        # Sinon, on essaie d'accéder à une clé de dictionnaire (absente -> None)
+        elif current.__class__ is dict:
+            current = current.get(key)
         else:
             return None # Clé introuvable
  
-    # Nettoyage final : si le résultat est une référence FHIR, on la nettoie
-    if isinstance(current, str):
-        for prefix in ["urn:uuid:", "Patient/", "Encounter/", "Practitioner/", "Location/"]:
+    # Nettoyage final : si le résultat est une référence FHIR, on la nettoie.
+    # Tous les préfixes contiennent "/" ou "urn:uuid:" : un seul test évite les
+    # cinq parcours de replace sur les valeurs ordinaires (textes, dates, codes).
+    if isinstance(current, str) and ("/" in current or "urn:uuid:" in current):
+        for prefix in _FHIR_REF_PREFIXES:
             current = current.replace(prefix, "")
  
     return current
@@ -351,12 +394,23 @@ def _coalesce_from(df: pl.DataFrame, target: str, src: str) -> pl.DataFrame:
     Équivalent du COALESCE(target, src) en SQL.
     Utilisé pour consolider des données provenant de deux champs différents.
     """
-    if target in df.columns and src in df.columns:
-        # pl.coalesce prend la première valeur non-nulle de la liste
-        df = df.with_columns(pl.coalesce([pl.col(target), pl.col(src)]).alias(target))
-        # On supprime la colonne source intermédiaire pour nettoyer
-        df = df.drop(src)
-    return df
+    return _coalesce_pairs(df, [(target, src)])
+ 
+ 
+def _coalesce_pairs(df, pairs: list[tuple[str, str]]):
+    """Applique _coalesce_from à plusieurs couples (target, src) en une seule passe.
+ 
+    Un seul with_columns puis un seul drop (DataFrame ou LazyFrame) ;
+    les couples dont une colonne est absente sont ignorés.
+    """
+    columns = set(df.columns)
+    pairs = [(target, src) for target, src in pairs if target in columns and src in columns]
+    if not pairs:
+        return df
+    # pl.coalesce prend la première valeur non-nulle de la liste
+    df = df.with_columns([pl.coalesce([pl.col(target), pl.col(src)]).alias(target) for target, src in pairs])
+    # On supprime les colonnes sources intermédiaires pour nettoyer
+    return df.drop([src for _, src in pairs])
  
  
 # def write_last_run_report(result: dict, target_eds_dir: str, filename: str = "last_run.json") -> None:
@@ -598,6 +652,16 @@ def _coalesce_from_path(df: pl.DataFrame, target: str, src: str) -> pl.DataFrame
     return df
 
 
+# Options d'écriture des tables EDS (build et merge) : zstd niveau 3, statistiques
+# par column chunk (pushdown des prédicats pour les scan_parquet suivants) et row
+# groups bornés. A passer en **kwargs à write_parquet / sink_parquet.
+PARQUET_WRITE_OPTIONS = {
+    "compression": "zstd",
+    "compression_level": 3,
+    "statistics": True,
+    "row_group_size": 128_000,
+}
+
 
 def parquet_row_count(path: str | Path) -> int:
     """Retourne le nombre de lignes d'un parquet, 0 si fichier absent."""